@@ -1,22 +1,36 @@
 from fastapi import FastAPI
 from argparse import ArgumentParser
 import uvicorn
-from .state import State, ClientReport, AccountId
-from fastapi import Request, Response, HTTPException
+from .state import (
+    State,
+    ClientReport,
+    RawClientReport,
+    AccountId,
+    FsReportWriter,
+    StartInfo,
+)
+from fastapi import Request, Response, HTTPException, BackgroundTasks
+from fastapi.exceptions import RequestValidationError
+from pydantic import TypeAdapter, ValidationError
 import asyncio
+import os
 
 app = FastAPI()
 state = None
 
+# SAM_DISPATCH_FAST=1 skips validating individual messages on upload
+if os.environ.get("SAM_DISPATCH_FAST") == "1":
+    _report_adapter = TypeAdapter(RawClientReport)
+else:
+    _report_adapter = TypeAdapter(ClientReport)
+
 
 def auth(request: Request):
-    try:
-        client_id = request.cookies.get("id")
-    except:
+    # cookie already holds the full id built in /client, it is only valid
+    # from the host it was issued to
+    _id = request.cookies.get("id")
+    if _id is None or _id.partition("#")[0] != request.client.host:
         raise HTTPException(status_code=401)
-    host = request.client.host
-    _id = create_id(host, client_id)
-
     if not state.is_auth(_id):
         raise HTTPException(status_code=401)
     return _id
@@ -27,13 +41,19 @@ def create_id(host: str, id: str):
 
 
 @app.get("/client")
-async def client(request: Request, response: Response):
-    client_id = await state.next_client_id()
-    response.set_cookie(key="id", value=client_id)
-    client_data = await state.get_client(create_id(request.client.host, client_id))
+async def client(request: Request):
+    client_id = state.next_client_id()
+    _id = create_id(request.client.host, client_id)
+    client_data = await state.get_client(_id)
     if client_data is None:
         raise HTTPException(status_code=403)
-    return client_data
+    # client json is cached in init_state, skip response model serialization
+    response = Response(
+        content=state.client_json(client_data.username),
+        media_type="application/json",
+    )
+    response.set_cookie(key="id", value=_id, httponly=True, samesite="strict")
+    return response
 
 
 @app.post("/id")
@@ -43,14 +63,21 @@ async def upload_id(request: Request, account_id: AccountId):
 
 
 @app.get("/sync")
-async def sync(request: Request):
+async def sync(request: Request) -> StartInfo:
     return await state.start(auth(request))
 
 
 @app.post("/upload")
-async def upload(request: Request, report: ClientReport):
+async def upload(request: Request, background: BackgroundTasks):
     _id = auth(request)
-    await state.report(_id, report)
+    # validate the raw body once instead of going through fastapi's body model
+    try:
+        report = _report_adapter.validate_json(await request.body())
+    except ValidationError as e:
+        raise RequestValidationError(e.errors())
+    if await state.report(_id, report):
+        # final report is written after the response is sent
+        background.add_task(state.save_report)
 
 
 @app.get("/health")
@@ -58,9 +85,9 @@ async def health():
     return "OK"
 
 
-async def setup_state(path: str):
+async def setup_state(path: str, indent: bool = False):
     global state
-    state = State(path)
+    state = State(path, FsReportWriter(indent=indent))
     await state.init_state()
     return state.scenario.address.split(":")
 
@@ -71,8 +98,19 @@ def main():
         "sam-dispatch", description="Automated setup of test clients"
     )
     parser.add_argument("config", help="Path to config")
+    parser.add_argument(
+        "--indent", action="store_true", help="Write the report as indented json"
+    )
     args = parser.parse_args()
     config_path: str = args.config
 
-    ip, port = asyncio.run(setup_state(config_path))
-    uvicorn.run("sam_dispatcher.server:app", host=ip, port=int(port))
+    ip, port = asyncio.run(setup_state(config_path, args.indent))
+    uvicorn.run(
+        "sam_dispatcher.server:app",
+        host=ip,
+        port=int(port),
+        loop="uvloop",
+        http="httptools",
+        access_log=False,
+        log_level="warning",
+    )
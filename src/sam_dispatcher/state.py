@@ -1,14 +1,16 @@
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, model_serializer, model_validator
 from typing import Tuple, Dict, Optional, List
-import uuid
+import os
+import itertools
 import random
-import math
-import time
 from pathlib import Path
 from asyncio import Lock
 import asyncio
 import numpy as np
-from copy import deepcopy
+import orjson
+from collections import deque
+
+_rng = np.random.default_rng()
 
 
 class Scenario(BaseModel):
@@ -29,10 +31,31 @@ class Scenario(BaseModel):
     report: str = Field(alias="report", default="report.json")
 
 
-class Friend(BaseModel):
-    username: str = Field()
-    frequency: float = Field()
-    denim: bool = Field()
+# friends are stored column wise instead of one object per friendship edge,
+# on the wire they stay a username -> {username, frequency, denim} mapping
+class FriendTable(BaseModel):
+    usernames: List[str] = Field(default_factory=list)
+    frequencies: List[float] = Field(default_factory=list)
+    denim: List[bool] = Field(default_factory=list)
+
+    @model_validator(mode="before")
+    @classmethod
+    def _from_mapping(cls, data):
+        if isinstance(data, dict) and "usernames" not in data:
+            friends = data.values()
+            return {
+                "usernames": [f["username"] for f in friends],
+                "frequencies": [f["frequency"] for f in friends],
+                "denim": [f["denim"] for f in friends],
+            }
+        return data
+
+    @model_serializer
+    def _to_mapping(self):
+        return {
+            name: {"username": name, "frequency": freq, "denim": denim}
+            for name, freq, denim in zip(self.usernames, self.frequencies, self.denim)
+        }
 
 
 class Client(BaseModel):
@@ -46,7 +69,7 @@ class Client(BaseModel):
     denim_probability: float = Field(alias="denimProbability")
     reply_probability: float = Field(alias="replyProbability")
     stale_reply: int = Field(alias="staleReply")
-    friends: Dict[str, Friend] = Field()
+    friends: FriendTable = Field()
 
 
 class MessageLog(BaseModel):
@@ -56,7 +79,7 @@ class MessageLog(BaseModel):
     size: int = Field()
     tick: int = Field()
 
-    model_config = {"populate_by_name": True}
+    model_config = {"populate_by_name": True, "extra": "ignore", "frozen": True}
 
 
 class ClientReport(BaseModel):
@@ -64,6 +87,12 @@ class ClientReport(BaseModel):
     messages: List[MessageLog]
 
 
+# messages are kept as decoded json, used when uploads are trusted
+class RawClientReport(BaseModel):
+    start_time: int = Field(alias="startTime")
+    messages: List[dict]
+
+
 class AccountId(BaseModel):
     account_id: str = Field(alias="accountId")
 
@@ -79,17 +108,27 @@ class StartInfo(BaseModel):
     friends: dict[str, str] = Field()
 
 
+def _dump_models(models: dict[str, BaseModel]) -> bytes:
+    return orjson.dumps({k: m.model_dump(by_alias=True) for k, m in models.items()})
+
+
 class ReportWriter:
-    def write(self, path: str, report: Report):
+    def write(self, path: str, data: bytes):
         pass
 
 
 class FsReportWriter:
-    def write(self, path: str, report: Report):
+    def __init__(self, indent: bool = False):
+        self.indent = indent
+
+    def write(self, path: str, data: bytes):
+        # reports are compact unless asked for, indenting re-encodes the whole report
+        if self.indent:
+            data = orjson.dumps(orjson.loads(data), option=orjson.OPT_INDENT_2)
         _dir = Path("reports/")
         _dir.mkdir(exist_ok=True)
-        with open(_dir / path, "w") as f:
-            f.write(report.model_dump_json(indent=2, by_alias=True))
+        with open(_dir / path, "wb") as f:
+            f.write(data)
 
 
 class State:
@@ -106,7 +145,7 @@ class State:
             self.writer = FsReportWriter()
 
         self.clients: dict[str, Client] = dict()
-        self.free_clients: set[str] = set()
+        self.free_clients: deque[str] = deque()
 
         # ip, username
         self.usernames: dict[str, str] = dict()
@@ -114,27 +153,43 @@ class State:
         # username, account_id
         self.account_ids: dict[str, str] = dict()
 
-        self.reports: dict[str, ClientReport] = dict()
+        self.reports: dict[str, ClientReport | RawClientReport] = dict()
 
-        self.client_counter = 0
+        self.client_counter = itertools.count()
         self.saved = False
 
+        # running totals so readiness and upload checks don't rescan every client
+        self._assigned_count = 0
+        self._ready_count = 0
+        # set once every client is ready, wakes up waiters in start
+        self._ready_event = asyncio.Event()
+
+        # serialized once in init_state, scenario and clients never change after
+        self._scenario_json = b""
+        self._client_json: dict[str, bytes] = dict()
+        self._clients_json = b""
+
     def _reset(self):
         self.clients = dict()
-        self.free_clients = set()
+        self.free_clients = deque()
         self.usernames = dict()
         self.ready_clients = set()
+        self.account_ids = dict()
 
         self.reports = dict()
 
-        self.client_counter = 0
+        self.client_counter = itertools.count()
         self.saved = False
 
-    async def next_client_id(self):
-        id = self.client_counter
-        async with self.lock:
-            self.client_counter += 1
-        return id
+        self._assigned_count = 0
+        self._ready_count = 0
+        self._ready_event = asyncio.Event()
+
+    def next_client_id(self):
+        return next(self.client_counter)
+
+    def client_json(self, username: str) -> bytes:
+        return self._client_json[username]
 
     def is_auth(self, ip_id: str):
         return ip_id in self.usernames
@@ -145,63 +200,79 @@ class State:
 
     @property
     def clients_ready(self):
+        # account ids are only stored for assigned usernames, so counting them is enough
         return (
-            all(ip in self.ready_clients for ip in self.usernames)
-            and all(user in self.account_ids for user in self.usernames.values())
-            and len(self.free_clients) == 0
+            not self.free_clients
+            and self._ready_count == self._assigned_count
+            and len(self.account_ids) == self._assigned_count
         )
 
     @property
     def all_clients_have_uploaded(self):
-        usernames = set(self.usernames.values())
-        has_reports = len(self.reports) == len(self.clients)
-
-        return all(user in usernames for user in self.reports) and has_reports
+        # reports are keyed by assigned usernames, so lengths are enough
+        return len(self.reports) == self._assigned_count == len(self.clients)
 
-    async def set_account_id(self, ip_id: str, account_id: AccountId):
-        async with self.lock:
-            username = self.usernames[ip_id]
-            self.account_ids[username] = account_id
+    async def set_account_id(self, ip_id: str, account_id: str):
+        self.account_ids[self.usernames[ip_id]] = account_id
+        self._check_ready()
 
     async def start(self, ip_id: str) -> StartInfo:
         await self._ready(ip_id)
-        while not self.clients_ready:
-            await asyncio.sleep(0.5)
+        await self._ready_event.wait()
 
         friends = self.clients[self.usernames[ip_id]].friends
-        friends = dict(map(lambda x: (x[0], self.account_ids[x[0]]), friends.items()))
+        friends = {name: self.account_ids[name] for name in friends.usernames}
 
         return StartInfo(friends=friends)
 
     async def get_client(self, ip_id: str) -> Optional[Client]:
-        async with self.lock:
-            if len(self.free_clients) == 0:
-                return None
-            name = self.free_clients.pop()
-            self.usernames[ip_id] = name
-            return self.clients[name]
-
-    async def report(self, ip_id: str, report: ClientReport):
-        async with self.lock:
-            username = self.usernames[ip_id]
-            self.reports[username] = report
-            if self.all_clients_have_uploaded and not self.saved:
-                self.saved = True
-                await self.save_report()
+        try:
+            name = self.free_clients.popleft()
+        except IndexError:
+            return None
+        self.usernames[ip_id] = name
+        self._assigned_count += 1
+        self._check_ready()
+        return self.clients[name]
+
+    async def report(self, ip_id: str, report: ClientReport | RawClientReport) -> bool:
+        username = self.usernames[ip_id]
+        self.reports[username] = report
+        # no await between check and flag, only one upload can claim the save
+        if self.all_clients_have_uploaded and not self.saved:
+            self.saved = True
+            return True
+        return False
 
     async def save_report(self):
-        ips = {v: k.split("#")[0] for k, v in self.usernames.items()}
-        report = Report(
-            scenario=self.scenario,
-            ipAddresses=ips,
-            clients=self.clients,
-            reports=self.reports,
+        ips = {v: k.partition("#")[0] for k, v in self.usernames.items()}
+        # splice the cached fragments instead of dumping a full Report model
+        data = b"".join(
+            (
+                b'{"scenario":',
+                self._scenario_json,
+                b',"ipAddresses":',
+                orjson.dumps(ips),
+                b',"clients":',
+                self._clients_json,
+                b',"reports":',
+                _dump_models(self.reports),
+                b"}",
+            )
         )
-        self.writer.write(self.scenario.report, report)
+        # file io runs on a worker thread so the event loop keeps serving requests
+        await asyncio.to_thread(self.writer.write, self.scenario.report, data)
 
     async def _ready(self, ip: str):
-        async with self.lock:
+        if ip not in self.ready_clients:
+            self._ready_count += 1
             self.ready_clients.add(ip)
+        self._check_ready()
+
+    def _check_ready(self):
+        # readiness only flips once per run, the event doubles as the cached flag
+        if not self._ready_event.is_set() and self.clients_ready:
+            self._ready_event.set()
 
     @staticmethod
     def _init_client(
@@ -216,43 +287,54 @@ class State:
         reply_rate: int,
         stale_reply: int,
     ):
-        return Client(
+        # values are generated here, no need to validate them
+        return Client.model_construct(
             username=username,
-            clientType=client_type,
-            messageSizeRange=msg_range,
-            sendRate=send_rate,
-            tickMillis=tick_millis,
-            durationTicks=duration_ticks,
-            denimProbability=denim_prob,
-            replyProbability=reply_prob,
-            replyRate=reply_rate,
-            staleReply=stale_reply,
-            friends=dict(),
+            client_type=client_type,
+            message_size_range=msg_range,
+            send_rate=send_rate,
+            tick_millis=tick_millis,
+            duration_ticks=duration_ticks,
+            denim_probability=denim_prob,
+            reply_probability=reply_prob,
+            reply_rate=reply_rate,
+            stale_reply=stale_reply,
+            friends=FriendTable.model_construct(),
         )
 
     async def init_state(self):
         async with self.lock:
             self._reset()
-            total_clients = self.scenario.clients
-            tick_millis = self.scenario.tick_millis
-            duration_ticks = self.scenario.duration_ticks
+            scenario = self.scenario
+            total_clients = scenario.clients
+            tick_millis = scenario.tick_millis
+            duration_ticks = scenario.duration_ticks
+            client_type = scenario.type
+            denim_prob = scenario.denim_probability
+            reply_rate_range = scenario.reply_rate_range
+            stale_reply_range = scenario.stale_reply_range
+            reply_prob_range = scenario.reply_probability
             clients = dict()
 
+            # one random read for every username, 8 bytes each, usernames stay
+            # random so accounts from earlier runs on the same server never clash
+            raw = os.urandom(8 * total_clients)
+            usernames = [raw[i : i + 8].hex() for i in range(0, len(raw), 8)]
+
             # initialize clients
-            for _ in range(total_clients):
-                username = str(uuid.uuid4())
+            for username in usernames:
                 msg_range, send_rate = self._get_sizes_and_rate()
-                reply_rate = random.randint(*self.scenario.reply_rate_range)
-                stale_reply = random.randint(*self.scenario.stale_reply_range)
-                reply_prob = random.uniform(*self.scenario.reply_probability)
+                reply_rate = random.randint(*reply_rate_range)
+                stale_reply = random.randint(*stale_reply_range)
+                reply_prob = random.uniform(*reply_prob_range)
                 clients[username] = State._init_client(
                     username,
-                    self.scenario.type,
+                    client_type,
                     msg_range,
                     send_rate,
                     tick_millis,
                     duration_ticks,
-                    self.scenario.denim_probability,
+                    denim_prob,
                     reply_prob=reply_prob,
                     reply_rate=reply_rate,
                     stale_reply=stale_reply,
@@ -260,26 +342,44 @@ class State:
 
             self.clients = clients
             self._make_friends(self.clients)
-            self.free_clients: set[str] = {c.username for c in self.clients.values()}
+            names = list(self.clients)
+            random.shuffle(names)
+            self.free_clients = deque(names)
+
+            self._scenario_json = orjson.dumps(self.scenario.model_dump(by_alias=True))
+            self._client_json = {
+                name: orjson.dumps(c.model_dump(by_alias=True))
+                for name, c in self.clients.items()
+            }
+            self._clients_json = (
+                b"{"
+                + b",".join(
+                    orjson.dumps(name) + b":" + data
+                    for name, data in self._client_json.items()
+                )
+                + b"}"
+            )
 
     def _make_friends(self, clients: dict[str, Client]):
-        names = set(clients.keys())
+        names = list(clients.keys())
+        random.shuffle(names)
         client_amount = len(names)
-        groups: list[list[str]] = []
-
-        fraction = client_amount / self.scenario.groups / client_amount
-        for _ in range(self.scenario.groups):
-            group_amount = math.floor(client_amount * fraction)
-            current_group = [names.pop() for _ in range(group_amount)]
-            groups.append(current_group)
-
-        if len(names) != 0:
-            for group in groups:
-                if len(names) == 0:
-                    break
-                group.append(names.pop())
-
-        denim_pairs: dict[str, str] = dict()
+        group_amount = self.scenario.groups
+
+        # equal sized groups, leftover names go one each to the first groups
+        sizes = [client_amount // group_amount] * group_amount
+        for i in range(client_amount % group_amount):
+            sizes[i] += 1
+
+        # clients are referred to by their index in names from here on,
+        # every group is a contiguous range of indices
+        groups: list[range] = []
+        offset = 0
+        for size in sizes:
+            groups.append(range(offset, offset + size))
+            offset += size
+
+        denim_pairs: dict[int, int] = dict()
         prev = None
         for group in groups:
             if prev is None:
@@ -289,59 +389,54 @@ class State:
                 denim_pairs[group[0]] = prev
                 prev = None
 
-        friends: dict[str, set[str]] = dict()
+        # every group is fully connected, each edge is a (src, dst) index pair
+        src_parts = []
+        dst_parts = []
         for group in groups:
-            for name in group:
-                friends[name] = {n for n in group if n != name}
-
-        for name, group in friends.items():
-            for friend in group:
-                clients[name].friends[friend] = Friend(
-                    username=friend, denim=False, frequency=0
-                )
-
-        for name, friend_name in denim_pairs.items():
-            friend = Friend(
-                username=friend_name,
-                denim=True,
-                frequency=0,
-            )
-            clients[name].friends[friend_name] = friend
+            members = np.arange(group.start, group.stop)
+            grid_src, grid_dst = np.meshgrid(members, members, indexing="ij")
+            others = grid_src != grid_dst
+            src_parts.append(grid_src[others])
+            dst_parts.append(grid_dst[others])
+        src_parts.append(np.fromiter(denim_pairs.keys(), dtype=np.int64))
+        dst_parts.append(np.fromiter(denim_pairs.values(), dtype=np.int64))
+
+        # csr adjacency, friends of client i are dst[offsets[i]:offsets[i + 1]]
+        src = np.concatenate(src_parts).astype(np.int64)
+        dst = np.concatenate(dst_parts).astype(np.int64)
+        order = np.argsort(src, kind="stable")
+        src = src[order]
+        dst = dst[order]
+        counts = np.bincount(src, minlength=client_amount)
+        offsets = [0] + np.cumsum(counts).tolist()
 
         # create weighted friends
-        for client in clients.values():
-            friend_amount = len(client.friends)
-
-            # dirichlet distribution for skewed friends
-            samples = np.random.dirichlet([self.scenario.friend_alpha] * friend_amount)
-            samples = [float(x) for x in samples]
-
-            for freq, ab_friend in zip(samples, client.friends.values()):
-                ab_friend.frequency = freq
-
-        # make mutual friendships
-        mutuals: dict[tuple, float] = dict()
-        for client in clients.values():
-            for f, ab_friend in client.friends.items():
-                pair = tuple(sorted((client.username, f)))
-                if pair in mutuals:
-                    continue
-                ab_freq = ab_friend.frequency
-                ba_friend = clients[f].friends[client.username]
-                ba_freq = ba_friend.frequency
-
-                mutual = (ab_freq + ba_freq) / 2
-                mutuals[pair] = mutual
-
-        #  Normalize all mutual weights globally
-        total = sum(mutuals.values())
-        for pair in mutuals:
-            mutuals[pair] /= total
-
-        # Assign normalized frequency to both A and B
-        for (a, b), freq in mutuals.items():
-            clients[a].friends[b].frequency = freq
-            clients[b].friends[a].frequency = freq
+        # dirichlet distribution for skewed friends, drawn as one gamma sample
+        # per edge normalized by the total of the client the edge starts at
+        freqs = _rng.gamma(self.scenario.friend_alpha, 1.0, len(dst))
+        totals = np.bincount(src, weights=freqs, minlength=client_amount)[src]
+        freqs = np.divide(freqs, totals, out=np.zeros_like(freqs), where=totals > 0)
+
+        # make mutual friendships, rev[e] is the edge going the other way
+        keys = src * client_amount + dst
+        order = np.argsort(keys)
+        rev = order[np.searchsorted(keys, dst * client_amount + src, sorter=order)]
+        mutuals = (freqs + freqs[rev]) * 0.5
+
+        #  Normalize all mutual weights globally, each pair shows up twice
+        mutuals /= mutuals.sum() * 0.5
+
+        # only now fill the friend tables, both sides of a pair share the frequency
+        dst_list = dst.tolist()
+        mutual_list = mutuals.tolist()
+        for i, name in enumerate(names):
+            friend_ids = dst_list[offsets[i] : offsets[i + 1]]
+            denim_friend = denim_pairs.get(i)
+            clients[name].friends = FriendTable.model_construct(
+                usernames=[names[j] for j in friend_ids],
+                frequencies=mutual_list[offsets[i] : offsets[i + 1]],
+                denim=[j == denim_friend for j in friend_ids],
+            )
 
     def _get_sizes_and_rate(self):
         min_rate, max_rate = self.scenario.send_rate_range
@@ -0,0 +1,68 @@
+import pytest
+import asyncio
+from fastapi.testclient import TestClient
+from sam_dispatcher import server
+from sam_dispatcher.state import State, Scenario
+
+scenario = Scenario(
+    name="test",
+    type="denim-on-sam",
+    clients=2,
+    groups=1,
+    tickMillis=10,
+    durationTicks=10,
+    messageSizeRange=(10, 20),
+    denimProbability=0.1,
+    sendRateRange=(1, 5),
+    replyRateRange=(1, 2),
+    replyProbability=(0.5, 0.95),
+    staleReplyRange=(1, 1),
+    friendAlpha=0.3,
+)
+
+
+@pytest.fixture
+def state():
+    server.state = State(scenario)
+    asyncio.run(server.state.init_state())
+    yield server.state
+    server.state = None
+
+
+def test_cookie_from_other_host_is_rejected(state: State):
+    owner = TestClient(server.app, client=("10.0.0.1", 50000))
+    response = owner.get("/client")
+    assert response.status_code == 200
+    cookie = response.cookies["id"]
+    assert owner.post("/id", json={"accountId": "a"}).status_code == 200
+
+    other = TestClient(server.app, client=("10.0.0.2", 50000))
+    other.cookies.set("id", cookie)
+    assert other.post("/id", json={"accountId": "b"}).status_code == 401
+    assert state.account_ids == {state.usernames[cookie]: "a"}
+
+
+def test_sync_returns_friend_account_ids(state: State):
+    clients = [TestClient(server.app, client=(f"10.0.0.{i}", 50000)) for i in (1, 2)]
+    for i, client in enumerate(clients):
+        assert client.get("/client").status_code == 200
+        client.post("/id", json={"accountId": f"account_{i}"})
+
+    # second client finishes readiness, so the first waiter is released after it
+    responses = [None, None]
+
+    def sync(i):
+        responses[i] = clients[i].get("/sync")
+
+    import threading
+
+    threads = [threading.Thread(target=sync, args=(i,)) for i in (0, 1)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(timeout=5)
+
+    assert [r.json() for r in responses] == [
+        {"friends": {state.usernames["10.0.0.2#1"]: "account_1"}},
+        {"friends": {state.usernames["10.0.0.1#0"]: "account_0"}},
+    ]
@@ -4,10 +4,12 @@ from sam_dispatcher.state import (
     Scenario,
     Report,
     ClientReport,
+    RawClientReport,
     MessageLog,
     StartInfo,
 )
 import math
+import orjson
 import time
 import asyncio
 
@@ -37,7 +39,7 @@ async def test_can_get_client(scenario: Scenario):
     await state.init_state()
     client = await state.get_client("127.0.0.1")
 
-    denim_friends = filter(lambda x: x.denim, client.friends.values())
+    denim_friends = filter(None, client.friends.denim)
     assert client is not None
     assert client.duration_ticks == state.scenario.duration_ticks
     assert client.tick_millis == state.scenario.tick_millis
@@ -47,7 +49,7 @@ async def test_can_get_client(scenario: Scenario):
         <= state.scenario.send_rate_range[1]
     )
 
-    assert all(f.denim for f in denim_friends)
+    assert all(denim_friends)
 
 
 @pytest.mark.asyncio
@@ -58,8 +60,8 @@ async def test_groups_have_denim_connection(scenario: Scenario):
     groups = state.scenario.groups
     count = 0
     for c in state.clients.values():
-        for f in c.friends.values():
-            if f.denim:
+        for denim in c.friends.denim:
+            if denim:
                 count += 1
     assert count == groups
 
@@ -69,10 +71,12 @@ async def test_groups_have_denim_connection(scenario: Scenario):
 async def test_no_friendless_clients(scenario: Scenario):
     state = State(scenario)
     await state.init_state()
-    friend_counts = {f.username: len(f.friends) for f in state.clients.values()}
+    friend_counts = {
+        f.username: len(f.friends.usernames) for f in state.clients.values()
+    }
     friendless_clients = sum(1 for x in friend_counts.values() if x == 0)
     all_has_friends = all(friend_counts.values())
-    print([len(x.friends) for x in state.clients.values()])
+    print([len(x.friends.usernames) for x in state.clients.values()])
     assert (
         all_has_friends
     ), f"Expected all clients to have friends found '{friendless_clients}' without any"
@@ -94,17 +98,32 @@ async def test_client_freqs_add_to_one(scenario: Scenario):
     await state.init_state()
     total = 0
     for client in state.clients.values():
-        total += sum(f.frequency for f in client.friends.values())
+        total += sum(client.friends.frequencies)
     # sums all client frequencies, friends have two pairs of the same
     # freq leading the total to be two times higher than actual
     assert math.isclose(total / 2, 1.0, rel_tol=1e-9), f"Sum was {total}"
 
 
+@pytest.mark.asyncio
+@pytest.mark.parametrize("scenario", scenarios)
+async def test_client_friends_serialize_as_mapping(scenario: Scenario):
+    state = State(scenario)
+    await state.init_state()
+    client = next(iter(state.clients.values()))
+    friends = orjson.loads(state.client_json(client.username))["friends"]
+
+    assert list(friends) == client.friends.usernames
+    for name, freq, denim in zip(
+        client.friends.usernames, client.friends.frequencies, client.friends.denim
+    ):
+        assert friends[name] == {"username": name, "frequency": freq, "denim": denim}
+
+
 class TestReportWriter:
     report = None
 
-    def write(self, path: str, report: Report):
-        self.report = report
+    def write(self, path: str, data: bytes):
+        self.report = Report.model_validate_json(data)
 
 
 @pytest.mark.asyncio
@@ -138,8 +157,49 @@ async def test_ready_to_save(scenario: Scenario):
             messages=[MessageLog(type="regular", to="x", from_="x", size=1, tick=10)],
         )
         expected_report.reports[user] = report
-        await state.report(ip, report)
+        if await state.report(ip, report):
+            await state.save_report()
 
     report = writer.report
     assert report is not None
     assert report == expected_report
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("scenario", scenarios)
+async def test_raw_reports_are_saved(scenario: Scenario):
+    writer = TestReportWriter()
+    state = State(scenario, writer)
+    await state.init_state()
+
+    message = {"type": "denim", "to": "x", "from": "y", "size": 2, "tick": 3}
+    for i in range(state.scenario.clients):
+        ip = str(i)
+        await state.get_client(ip)
+        report = RawClientReport(startTime=0, messages=[message])
+        if await state.report(ip, report):
+            await state.save_report()
+
+    report = writer.report
+    assert report is not None
+    for client_report in report.reports.values():
+        assert client_report.messages == [MessageLog.model_validate(message)]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("scenario", scenarios)
+async def test_reupload_does_not_save_early(scenario: Scenario):
+    state = State(scenario, TestReportWriter())
+    await state.init_state()
+    for i in range(state.scenario.clients):
+        await state.get_client(str(i))
+
+    report = ClientReport(startTime=0, messages=[])
+    for _ in range(state.scenario.clients):
+        assert not await state.report("0", report)
+    assert not state.all_clients_have_uploaded
+
+    claims = [
+        await state.report(str(i), report) for i in range(1, state.scenario.clients)
+    ]
+    assert claims.count(True) == 1 and claims[-1]